@@ -1,9 +1,12 @@
 import streamlit as st
 from supabase import create_client, Client
-import json
+import orjson
 import os
-import tempfile
 import datetime
+import gzip
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import pandas as pd
 
 # =========================
@@ -17,86 +20,268 @@ st.set_page_config(
 # =========================
 # SUPABASE CONNECTION
 # =========================
+# project URL without a trailing slash, so derived Storage URLs never get "//"
+SUPABASE_URL = st.secrets["SUPABASE_URL"].rstrip("/")
+
 @st.cache_resource
 def init_connection() -> Client:
     return create_client(
-        st.secrets["SUPABASE_URL"],
+        SUPABASE_URL,
         st.secrets["SUPABASE_ANON_KEY"]
     )
 
+@st.cache_resource
+def init_storage_http() -> httpx.Client:
+    # plain HTTP client for Storage reads that need conditional headers
+    key = st.secrets["SUPABASE_ANON_KEY"]
+    return httpx.Client(
+        base_url=f"{SUPABASE_URL}/storage/v1",
+        headers={"apikey": key, "Authorization": f"Bearer {key}"},
+        timeout=30,
+    )
+
 supabase: Client = init_connection()
+storage_http: httpx.Client = init_storage_http()
 BUCKET = st.secrets["SUPABASE_BUCKET"]
+PUBLIC_URL_BASE = f"{SUPABASE_URL}/storage/v1/object/public"
+
+# Grid previews can be served pre-resized by Supabase image transformations
+# (render endpoint, paid plans only); opt in with SUPABASE_IMAGE_TRANSFORMS.
+USE_THUMBNAILS = bool(st.secrets.get("SUPABASE_IMAGE_TRANSFORMS", False))
+THUMBNAIL_URL_BASE = f"{SUPABASE_URL}/storage/v1/render/image/public"
+THUMBNAIL_QUERY = "?width=256&quality=70&resize=contain"
 
 st.title("🖋️ Calligraphy Annotation Tool (Grid Mode)")
 
+ANN_FIELDS = [
+    "text_original",
+    "text_latinized",
+    "text_translation_tr",
+    "surah_name",
+    "ayah_number",
+    "comment",
+]
+# columns saved to annotations.json; the image URL is display-only
+RECORD_COLUMNS = ["id", *ANN_FIELDS]
+GRID_COLUMNS = ["image", *RECORD_COLUMNS]
+
+IMG_EXTS = frozenset({".jpg", ".jpeg", ".png", ".webp"})
+
+# seconds a bucket listing is reused before Storage is asked again; listings
+# are cached as shared tuples (cache_resource) so hits skip the pickle copy
+LIST_CACHE_TTL = 120
+
 # =========================
 # SUPABASE HELPERS
 # =========================
 
+@st.cache_resource(ttl=LIST_CACHE_TTL, max_entries=32, show_spinner=False)
 def get_folders(bucket: str):
-    """Always fetch live folder list (no caching)."""
+    """Fetch folder list (cached briefly so reruns don't re-list the bucket)."""
     res = supabase.storage.from_(bucket).list("", {"limit": 500})
-    return sorted([i["name"] for i in res if i.get("metadata") is None])
+    return tuple(sorted(i["name"] for i in res if i.get("metadata") is None))
 
+@st.cache_resource(ttl=LIST_CACHE_TTL, max_entries=32, show_spinner=False)
 def get_image_urls(bucket: str, folder: str):
-    """Always fetch live image list (no caching)."""
+    """Fetch image list (cached briefly; use "Refresh images" to force)."""
     files = supabase.storage.from_(bucket).list(folder)
-    urls = []
-    for f in files:
-        name = f["name"]
-        if name.lower().endswith((".jpg", ".jpeg", ".png")):
-            urls.append(
-                supabase.storage.from_(bucket).get_public_url(f"{folder}/{name}")
-            )
-    return sorted(urls)
-
-def load_existing_annotations(bucket: str, folder: str, filename: str):
-    """Load JSON file from Supabase Storage if it exists."""
+    # public URLs follow a fixed schema; build them locally instead of
+    # going through the SDK once per file
+    base = f"{PUBLIC_URL_BASE}/{bucket}/{folder}"
+    splitext = os.path.splitext
+    return tuple(sorted(
+        f"{base}/{f['name']}"
+        for f in files
+        if splitext(f["name"])[1].lower() in IMG_EXTS
+    ))
+
+def is_not_found(res: httpx.Response) -> bool:
+    """Storage reports a missing object as 404, or as 400 with a not_found body."""
+    if res.status_code == 404:
+        return True
+    if res.status_code != 400:
+        return False
     try:
-        remote_path = f"{folder}/{filename}"
-        res = supabase.storage.from_(bucket).download(remote_path)
-        if res:
-            data = json.loads(res.decode("utf-8"))
-            return data
-    except Exception:
-        pass
-    return []
-
-def backup_and_upload_json(data_obj, bucket: str, folder: str, filename: str):
-    """Create a timestamped backup, then overwrite the main JSON file."""
-    try:
-        # 1) backup
-        ts = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-        backup_name = f"{filename.replace('.json','')}-{ts}.json"
-        backup_path = f"{folder}/_backups/{backup_name}"
-
-        with tempfile.NamedTemporaryFile("w", delete=False, suffix=".json", encoding="utf-8") as tmp_bk:
-            json.dump(data_obj, tmp_bk, ensure_ascii=False, indent=2)
-            tmp_bk_path = tmp_bk.name
-
-        supabase.storage.from_(bucket).upload(
-            backup_path,
-            tmp_bk_path,
-            file_options={"content-type": "application/json", "x-upsert": "true"}
-        )
-
-        # 2) overwrite main JSON
-        with tempfile.NamedTemporaryFile("w", delete=False, suffix=".json", encoding="utf-8") as tmp_main:
-            json.dump(data_obj, tmp_main, ensure_ascii=False, indent=2)
-            tmp_main_path = tmp_main.name
+        body = orjson.loads(res.content)
+    except orjson.JSONDecodeError:
+        return False
+    return isinstance(body, dict) and (
+        body.get("error") == "not_found" or str(body.get("statusCode")) == "404"
+    )
 
-        main_remote_path = f"{folder}/{filename}"
+def load_existing_annotations(bucket: str, folder: str, filename: str, etag=None):
+    """Load JSON file from Supabase Storage; a missing file means no annotations.
+
+    Returns (etag, records_by_id). When `etag` is given and the file is
+    unchanged (HTTP 304), returns (etag, None) without downloading the body.
+    Any other failure raises, so callers never mistake it for an empty file.
+    """
+    remote_path = f"{folder}/{filename}"
+    headers = {"If-None-Match": etag} if etag else {}
+    res = storage_http.get(f"/object/{bucket}/{remote_path}", headers=headers)
+    if filename.endswith(".gz") and is_not_found(res):
+        # folder not saved since compression was introduced: read the
+        # plain JSON file written before
+        return load_existing_annotations(bucket, folder, filename[:-3], etag)
+    if is_not_found(res):
+        return None, {}
+    if res.status_code == 304:
+        return etag, None
+    res.raise_for_status()
+    body = res.content
+    if not body:
+        return res.headers.get("etag"), {}
+    if filename.endswith(".gz"):
+        body = gzip.decompress(body)
+    data = orjson.loads(body)
+    return res.headers.get("etag"), index_by_id(normalize_records(data))
+
+def upload_bytes(bucket: str, remote_path: str, payload: bytes, content_type: str):
+    """Upsert an in-memory payload to Storage (no temp file on disk)."""
+    supabase.storage.from_(bucket).upload(
+        path=remote_path,
+        file=payload,
+        file_options={"content-type": content_type, "x-upsert": "true"},
+    )
 
-        supabase.storage.from_(bucket).upload(
-            main_remote_path,
-            tmp_main_path,
-            file_options={"content-type": "application/json", "x-upsert": "true"}
+def write_annotations(payload: bytes, bucket: str, folder: str, filename: str):
+    """Upload a timestamped backup and overwrite the main JSON file.
+
+    Backups are always gzipped; the main file is too if `filename` ends in .gz.
+    """
+    ts = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    stem = filename.removesuffix(".gz").removesuffix(".json")
+    backup_path = f"{folder}/_backups/{stem}-{ts}.json.gz"
+    main_remote_path = f"{folder}/{filename}"
+
+    # compress once; backup and (gzipped) main file share the same bytes
+    gz_payload = gzip.compress(payload, compresslevel=6)
+    if filename.endswith(".gz"):
+        main_payload, main_type = gz_payload, "application/gzip"
+    else:
+        main_payload, main_type = payload, "application/json"
+
+    # backup and main file are independent writes, so upload them in parallel
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_backup = ex.submit(
+            upload_bytes, bucket, backup_path, gz_payload, "application/gzip"
+        )
+        f_main = ex.submit(
+            upload_bytes, bucket, main_remote_path, main_payload, main_type
         )
+        f_backup.result()
+        f_main.result()
+
+@st.cache_resource
+def init_upload_pool() -> ThreadPoolExecutor:
+    # shared by all sessions; pool threads are joined at interpreter exit,
+    # so saves that were already submitted still complete on shutdown
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="upload")
+
+upload_pool: ThreadPoolExecutor = init_upload_pool()
+
+def start_save(job, bucket: str, folder: str, filename: str, ann_key: str):
+    """Submit one (payload, digest, records) job; returns this session's ticket."""
+    future = upload_pool.submit(write_annotations, job[0], bucket, folder, filename)
+    return {
+        "future": future,
+        "job": job,
+        "next": None,
+        "bucket": bucket,
+        "folder": folder,
+        "filename": filename,
+        "ann_key": ann_key,
+    }
 
-        st.success(f"☁️ Saved → {main_remote_path}")
+def backup_and_upload_json(
+    payload: bytes, records, bucket: str, ann_key: str, folder: str, filename: str
+):
+    """Queue a timestamped backup plus overwrite of the main JSON file.
+
+    The upload runs on the shared pool and its ticket is kept in this
+    session's state until settle_saves() settles it. A save made while one
+    is in flight waits (only the latest is kept) and is sent afterwards.
+    Skips saving when the payload matches the latest save. Returns True if
+    a save was queued.
+    """
+    save_key = f"save::{folder}/{filename}"
+    digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    current = st.session_state.get(save_key)
+    if current is None:
+        latest_digest = st.session_state.get(f"last_hash::{folder}/{filename}")
+    else:
+        latest_digest = (current["next"] or current["job"])[1]
+    if latest_digest == digest:
+        st.info("No changes to save.")
+        return False
+
+    job = (payload, digest, records)
+    if current is None:
+        st.session_state[save_key] = start_save(job, bucket, folder, filename, ann_key)
+    else:
+        current["next"] = job
+    return True
+
+def pending_saves():
+    """Save tickets of this session that are still queued or in flight."""
+    return [k for k in list(st.session_state.keys()) if k.startswith("save::")]
+
+def settle_saves():
+    """Settle every finished save ticket of this session, whichever folder.
+
+    Runs in the main script before the grid is built, so a confirmed save
+    always lands in its folder's session copy first.
+    """
+    for save_key in pending_saves():
+        ticket = st.session_state[save_key]
+        if not ticket["future"].done():
+            continue
+
+        folder, filename = ticket["folder"], ticket["filename"]
+        msg_key = f"save_msg::{folder}/{filename}"
+        _, digest, records = ticket["job"]
+        try:
+            ticket["future"].result()
+        except Exception as e:
+            st.session_state[msg_key] = (
+                "error",
+                f"❌ Upload to {folder}/{filename} failed: {e}",
+            )
+        else:
+            st.session_state[f"last_hash::{folder}/{filename}"] = digest
+            st.session_state[ticket["ann_key"]] = index_by_id(records)
+            # the remote file changed, so a cached ETag no longer describes it
+            st.session_state.pop(f"ann_cache::{folder}/{filename}", None)
+            st.session_state[msg_key] = (
+                "success",
+                f"☁️ Saved {len(records)} annotations → {folder}/{filename}",
+            )
 
-    except Exception as e:
-        st.error(f"❌ Upload failed: {e}")
+        if ticket["next"] is not None:
+            st.session_state[save_key] = start_save(
+                ticket["next"], ticket["bucket"], folder, filename, ticket["ann_key"]
+            )
+        else:
+            del st.session_state[save_key]
+
+def show_save_messages():
+    """Report settled saves once (pops each message)."""
+    for msg_key in [k for k in list(st.session_state.keys()) if k.startswith("save_msg::")]:
+        kind, text = st.session_state.pop(msg_key)
+        getattr(st, kind)(text)
+
+@st.fragment(run_every=2)
+def watch_saves():
+    """Poll while saves are in flight; rerun the app once one finishes."""
+    if any(st.session_state[k]["future"].done() for k in pending_saves()):
+        st.rerun()
+    st.caption("⏳ Saving annotations…")
+
+def reload_annotations(ann_key: str, folder: str, filename: str):
+    """Drop the session copy so the next run re-downloads the file."""
+    st.session_state.pop(ann_key, None)
+    # the remote file may now differ from what this session last saved
+    st.session_state.pop(f"last_hash::{folder}/{filename}", None)
 
 def normalize_records(obj):
     """Ensure JSON is list[dict]."""
@@ -108,6 +293,34 @@ def normalize_records(obj):
         return [r for r in obj if isinstance(r, dict)]
     return []
 
+def df_to_records(df: pd.DataFrame):
+    """Fast replacement for df.to_dict(orient="records") on object columns."""
+    cols = list(df.columns)
+    rows = zip(*(df[c].to_numpy().tolist() for c in cols))
+    return [dict(zip(cols, row)) for row in rows]
+
+def to_thumbnail_urls(urls: pd.Series) -> pd.Series:
+    """Rewrite public object URLs to resized previews from the render endpoint."""
+    return urls.str.replace(PUBLIC_URL_BASE, THUMBNAIL_URL_BASE, n=1, regex=False) + THUMBNAIL_QUERY
+
+def index_by_id(records):
+    """Map records by their "id" (later duplicates win)."""
+    return {rec.get("id"): rec for rec in records}
+
+def build_grid_df(image_urls, existing_by_id):
+    """Left-join the image list with existing annotations on image id."""
+    urls = pd.Series(image_urls, dtype=object)
+    # basename without extension; every listed name has an image extension
+    df = pd.DataFrame({"id": urls.str.rpartition("/")[2].str.rpartition(".")[0]})
+
+    ann = (
+        pd.DataFrame(list(existing_by_id.values()), dtype=object)
+        .reindex(columns=RECORD_COLUMNS)
+        # reindex adds missing columns (e.g. no "id" at all) as float64
+        .astype(object)
+    )
+    return df.merge(ann, on="id", how="left").fillna("")[RECORD_COLUMNS]
+
 
 # =========================
 # FOLDER SELECTION
@@ -123,99 +336,171 @@ with col_folder:
     selected_folder = st.selectbox("📁 Choose folder", folders)
 
 with col_refresh:
-    if st.button("🔄 Refresh folders", use_container_width=True):
-        st.experimental_rerun()
+    st.button(
+        "🔄 Refresh folders",
+        on_click=get_folders.clear,
+        use_container_width=True,
+    )
 
 st.info(f"Selected folder: **{selected_folder}**")
 
-# Load images
-image_urls = get_image_urls(BUCKET, selected_folder)
-st.write(f"Total images: **{len(image_urls)}**")
+# =========================
+# LOAD IMAGES + EXISTING ANNOTATIONS
+# =========================
+ann_folder = f"{selected_folder}_annotations"
+# stored gzipped; folders not yet re-saved fall back to annotations.json
+ann_filename = "annotations.json.gz"
+# annotations are kept per folder for the session as {id: record}, the
+# canonical store the grid is built from; only "Reload annotations"
+# (or a successful save) replaces them, so reruns don't re-download the file
+ann_key = f"ann::{selected_folder}"
+# (etag, records) of the last download, so a reload can revalidate with
+# If-None-Match instead of re-downloading an unchanged file
+ann_cache_key = f"ann_cache::{ann_folder}/{ann_filename}"
+
+# settle finished saves (for any folder) before this folder's copy is read,
+# and poll only while some save is still in flight
+settle_saves()
+show_save_messages()
+if pending_saves():
+    watch_saves()
+
+cached_etag, cached_ann = st.session_state.get(ann_cache_key, (None, None))
+
+if ann_key in st.session_state:
+    image_urls = get_image_urls(BUCKET, selected_folder)
+else:
+    # the image LIST and the annotations DOWNLOAD are independent requests:
+    # download on a worker while the (cached) listing runs on the script
+    # thread, which Streamlit's cache needs for its ScriptRunContext
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        f_ann = ex.submit(
+            load_existing_annotations, BUCKET, ann_folder, ann_filename, cached_etag
+        )
+        image_urls = get_image_urls(BUCKET, selected_folder)
+        try:
+            etag, loaded = f_ann.result()
+        except Exception as e:
+            # leave ann_key unset so the next rerun retries the download
+            st.error(f"❌ Could not load annotations: {e}")
+        else:
+            if loaded is None:
+                st.session_state[ann_key] = cached_ann
+            else:
+                st.session_state[ann_key] = loaded
+                st.session_state[ann_cache_key] = (etag, st.session_state[ann_key])
+
+existing_by_id = st.session_state.get(ann_key)
+if existing_by_id is None and cached_ann is not None:
+    # a reload failed: keep showing the last good copy (without storing it,
+    # so the next rerun retries) rather than nothing
+    existing_by_id = cached_ann
+
+col_count, col_refresh_images, col_reload_ann = st.columns([2, 1, 1])
+
+with col_count:
+    st.write(f"Total images: **{len(image_urls)}**")
+
+with col_refresh_images:
+    st.button(
+        "🔄 Refresh images",
+        on_click=get_image_urls.clear,
+        use_container_width=True,
+    )
+
+with col_reload_ann:
+    st.button(
+        "🔄 Reload annotations",
+        on_click=reload_annotations,
+        args=(ann_key, ann_folder, ann_filename),
+        use_container_width=True,
+    )
 
 if not image_urls:
     st.warning("⚠️ This folder is empty.")
     st.stop()
 
-# =========================
-# LOAD EXISTING ANNOTATIONS
-# =========================
-ann_folder = f"{selected_folder}_annotations"
-ann_filename = "annotations.json"
-
-existing = normalize_records(load_existing_annotations(BUCKET, ann_folder, ann_filename))
-existing_by_id = {rec.get("id"): rec for rec in existing}
+if existing_by_id is None:
+    # never show a blank grid for a file we failed to read: Save would
+    # overwrite the stored annotations with it
+    st.stop()
 
 # =========================
 # BUILD GRID ROWS
 # =========================
-rows = []
-for url in image_urls:
-    img_name = os.path.basename(url)
-    image_id = os.path.splitext(img_name)[0]
-    base = existing_by_id.get(image_id, {})
-
-    row = {
-        "image": url,  # will be displayed as thumbnail
-        "id": image_id,
-        "text_original": base.get("text_original", ""),
-        "text_latinized": base.get("text_latinized", ""),
-        "text_translation_tr": base.get("text_translation_tr", ""),
-        "surah_name": base.get("surah_name", ""),
-        "ayah_number": base.get("ayah_number", ""),
-        "comment": base.get("comment", "")
-    }
-    rows.append(row)
-
-df = pd.DataFrame(rows)
+df = build_grid_df(image_urls, existing_by_id)
 
 # =========================
 # GRID UI
 # =========================
-st.markdown("### 🧾 Annotation Grid (edit directly and save)")
-
-edited_df = st.data_editor(
-    df,
-    key="ann_grid",
-    num_rows="fixed",
-    use_container_width=True,
-    column_config={
-        "image": st.column_config.ImageColumn(
-            "Image",
-            width="large",
-            help="Preview of the image"
-        ),
-        "id": st.column_config.TextColumn("ID"),
-        "text_original": st.column_config.TextColumn("Original Text"),
-        "text_latinized": st.column_config.TextColumn("Latinized"),
-        "text_translation_tr": st.column_config.TextColumn("Translation (TR)"),
-        "surah_name": st.column_config.TextColumn("Surah"),
-        "ayah_number": st.column_config.TextColumn("Ayah"),
-        "comment": st.column_config.TextColumn("Comment"),
-    },
-    hide_index=True,
-)
-
-# =========================
-# SAVE + DOWNLOAD
-# =========================
-col_save, col_download = st.columns(2)
-
-with col_save:
-    if st.button("💾 Save all annotations to Supabase", use_container_width=True):
-        records = edited_df.to_dict(orient="records")
-        backup_and_upload_json(
-            records,
-            BUCKET,
-            ann_folder,
-            ann_filename,
-        )
-        st.success(f"Saved {len(records)} annotations.")
-
-with col_download:
-    st.download_button(
-        "⬇️ Download annotations.json",
-        data=json.dumps(edited_df.to_dict(orient="records"), ensure_ascii=False, indent=2),
-        file_name="annotations.json",
-        mime="application/json",
+@st.fragment
+def annotations_grid(
+    df: pd.DataFrame, image_urls, ann_key: str, ann_folder: str, ann_filename: str
+):
+    """Editable grid with Save/Download; edits rerun only this fragment."""
+    st.markdown("### 🧾 Annotation Grid (edit directly and save)")
+
+    # the image column is materialized only for display and never saved
+    images = pd.Series(image_urls, index=df.index, dtype=object)
+    if USE_THUMBNAILS:
+        images = to_thumbnail_urls(images)
+
+    edited_df = st.data_editor(
+        df.assign(image=images),
+        key="ann_grid",
+        column_order=GRID_COLUMNS,
+        num_rows="fixed",
         use_container_width=True,
+        column_config={
+            "image": st.column_config.ImageColumn(
+                "Image",
+                width="large",
+                help="Preview of the image"
+            ),
+            "id": st.column_config.TextColumn("ID"),
+            "text_original": st.column_config.TextColumn("Original Text"),
+            "text_latinized": st.column_config.TextColumn("Latinized"),
+            "text_translation_tr": st.column_config.TextColumn("Translation (TR)"),
+            "surah_name": st.column_config.TextColumn("Surah"),
+            "ayah_number": st.column_config.TextColumn("Ayah"),
+            "comment": st.column_config.TextColumn("Comment"),
+        },
+        hide_index=True,
     )
+
+    # serialize once per run; Save and Download share the same bytes
+    records = df_to_records(edited_df[RECORD_COLUMNS])
+    payload = orjson.dumps(
+        records,
+        option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS,
+    )
+
+    # =========================
+    # SAVE + DOWNLOAD
+    # =========================
+    col_save, col_download = st.columns(2)
+
+    with col_save:
+        if st.button("💾 Save all annotations to Supabase", use_container_width=True):
+            if backup_and_upload_json(
+                payload,
+                records,
+                BUCKET,
+                ann_key,
+                ann_folder,
+                ann_filename,
+            ):
+                # full rerun so the app starts polling for the result
+                st.rerun()
+
+    with col_download:
+        st.download_button(
+            "⬇️ Download annotations.json",
+            data=payload,
+            file_name="annotations.json",
+            mime="application/json",
+            use_container_width=True,
+        )
+
+
+annotations_grid(df, image_urls, ann_key, ann_folder, ann_filename)